@@ -1,21 +1,34 @@
 #!/usr/bin/python3
 import logging
-from typing import Optional, List
-from collections import OrderedDict
+from typing import Dict, Iterator, Optional, List, Set, Tuple
 import os
 import re
 import typer
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
 logging.basicConfig()
 
+# Matches either a markdown link (group 1, left untouched) or a heading line
+_HEADING_RE = re.compile(r"(?m)(\[[^][]*]\([^()]*\))|^#.*")
+
+# Heading prefixes and ToC indents by depth, so typical trees never build them
+_HASHES = tuple("#" * i for i in range(32))
+_INDENTS = tuple("  " * i for i in range(32))
+
+# Readme reads are I/O bound, so use more threads than cores
+_MAX_READ_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
 
 class BadHeading(ValueError):
     pass
 
 
-@dataclass
+@dataclass(frozen=True)
 class ArchSection:
+    # Declared by hand as dataclass(slots=True) needs Python 3.10
+    __slots__ = ("path", "relative_path", "level", "body", "title")
+
     path: str
     relative_path: str
     level: int
@@ -23,91 +36,185 @@ class ArchSection:
     title: str
 
 
+def _repeat(table: Tuple[str, ...], unit: str, count: int) -> str:
+    # Precomputed repeats of unit, falling back for unusually deep trees
+    return table[count] if 0 <= count < len(table) else unit * count
+
+
 def _check_format(input: str):
     if not input.strip().startswith("# "):
         raise BadHeading()
 
 
-def _get_readme(file_dir: str, fname: str) -> Optional[str]:
-    file_path: str = os.path.join(file_dir, fname)
-    logging.debug("Looking for a file at %s", file_path)
+def _to_posix(path: str) -> str:
+    # Paths are handled with "/" separators throughout, whatever the platform
+    return path.replace(os.sep, "/")
 
-    if os.path.isfile(file_path):
-        logging.debug("Found a file at %s", file_path)
-        with open(file_path, "r") as f:
-            logging.debug("Reading file %s", file_path)
-            readme_str: str = f.read()
-        try:
-            _check_format(readme_str)
-        except BadHeading:
-            print(
-                f"WARNING: Readme at {file_path} does not start with a top level heading. Output structure may be malformed."
-            )
-        return readme_str
-    else:
+
+def _get_readme(file_path: str) -> Optional[str]:
+    logging.debug("Reading file %s", file_path)
+    try:
+        # Unbuffered, as the whole file is taken in a single read
+        with open(file_path, "rb", buffering=0) as f:
+            readme_bytes: bytes = f.read()
+    except OSError:
+        logging.debug("Could not read file %s", file_path)
         return None
+    readme_str: str = readme_bytes.decode("utf-8")
+    # Keep the universal newlines behaviour of text mode, only paying for the
+    # copies when there is something to translate
+    if "\r" in readme_str:
+        readme_str = readme_str.replace("\r\n", "\n").replace("\r", "\n")
+    return readme_str
+
+
+def _warn_bad_format(readme_str: str, file_path: str):
+    try:
+        _check_format(readme_str)
+    except BadHeading:
+        print(
+            f"WARNING: Readme at {file_path} does not start with a top level heading. Output structure may be malformed."
+        )
 
 
-def _is_dotfile(path: str):
-    path_split = path.split("/")
+def _iter_dirs(root_directory: str, fname: str) -> Iterator[Tuple[str, Optional[str]]]:
+    """Walk the tree top-down, yielding each directory with its readme path (if any)
 
-    nonroots: List[str] = path_split[1:]
-    for dir in nonroots:
-        if dir.startswith("."):
-            return True
-    return False
+    Directories starting with "." below the root are pruned along with their subtrees.
+    """
+    fname_lower: str = fname.lower()
+    # A readme name with a subpath never matches a single entry, so always
+    # ask the filesystem for it
+    fname_is_subpath: bool = "/" in fname or os.sep in fname
+
+    stack: List[str] = [root_directory]
+    while stack:
+        directory_path = stack.pop()
+        readme_path: Optional[str] = None
+        other_case: bool = False
+        subdirs: List[str] = []
+        try:
+            with os.scandir(directory_path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith("."):
+                            subdirs.append(_to_posix(entry.path))
+                    elif entry.name == fname and entry.is_file():
+                        readme_path = _to_posix(entry.path)
+                    elif entry.name.lower() == fname_lower:
+                        other_case = True
+        except OSError:
+            continue
+
+        # Let the filesystem's own case rules decide on near matches,
+        # e.g. Readme.md for README.md on macOS and Windows
+        if readme_path is None and (other_case or fname_is_subpath):
+            candidate: str = os.path.join(directory_path, fname)
+            if os.path.isfile(candidate):
+                readme_path = _to_posix(candidate)
+
+        yield directory_path, readme_path
+        # Reversed so subdirectories are popped in scandir order, as with os.walk
+        stack.extend(reversed(subdirs))
 
 
 def _reformat_readme(input: str, level: int):
-    regex = re.compile(r"(?m)(\[[^][]*]\([^()]*\))|^#.*", re.IGNORECASE)
-    prefix_levels: str = "#" * (level - 1)
-    out: str = regex.sub(
+    # Top level readmes keep their headings as-is
+    if level <= 1:
+        return input
+    prefix_levels: str = _repeat(_HASHES, "#", level - 1)
+    out: str = _HEADING_RE.sub(
         lambda x: x.group(1) if x.group(1) else f"{prefix_levels}{x.group(0)}", input
     )
     return out
 
 
-def _create_parents(output: OrderedDict, directory_path: str, root_directory: str):
-    relative_path = os.path.relpath(directory_path, root_directory)
-    relative_path_split = relative_path.split("/")
+def _create_parents(
+    seen_prefixes: Set[str], relative_path: str, root_prefix: str
+) -> Iterator[ArchSection]:
+    relative_level: int = _get_absolute_path_level(relative_path)
+    relative_title: str = relative_path[relative_path.rfind("/") + 1 :].upper()
 
-    for i, _ in enumerate(relative_path_split):
-        parent_relative_path: str = "/".join(relative_path_split[:i])
+    # Walk up from the closest parent, stopping at the first one already known.
+    # Parents are always added before their children, so every prefix above
+    # a known one is known too.
+    missing: List[Tuple[int, int]] = []
+    end: int = relative_path.rfind("/")
+    while end != -1 and relative_path[:end] not in seen_prefixes:
+        start: int = relative_path.rfind("/", 0, end) + 1
+        missing.append((start, end))
+        end = start - 1
 
-        parent_absolute_path: str = os.path.join(root_directory, parent_relative_path)
+    # Create the missing parents top-down to keep the output order
+    for start, end in reversed(missing):
+        parent_relative_path: str = relative_path[:end]
 
-        if parent_relative_path and (parent_absolute_path not in output):
-            logging.debug("Creating parent path %s", parent_relative_path)
+        parent_absolute_path: str = root_prefix + parent_relative_path
 
-            parent_name = relative_path_split[i - 1].upper()
-            parent_level: str = "#" * (i + 1)
+        logging.debug("Creating parent path %s", parent_relative_path)
 
-            output[parent_absolute_path] = ArchSection(
-                parent_absolute_path,
-                parent_relative_path,
-                len(relative_path_split),
-                f"{parent_level} {parent_name}\n",
-                relative_path_split[-1].upper(),
-            )
+        parent_name = relative_path[start:end].upper()
+        parent_level: str = _repeat(
+            _HASHES, "#", _get_absolute_path_level(parent_relative_path) + 1
+        )
+
+        seen_prefixes.add(parent_relative_path)
+        yield ArchSection(
+            parent_absolute_path,
+            parent_relative_path,
+            relative_level,
+            f"{parent_level} {parent_name}\n",
+            relative_title,
+        )
 
 
 def _get_absolute_path_level(dir_path: str) -> int:
-    dir_list: List[str] = dir_path.split("/")
-    return len(dir_list)
+    return dir_path.count("/") + 1
 
 
-def _build_doc_dict(
+def _iter_sections(
     root_directory: str, readme_filename: str, include_root: bool, title: str
-) -> OrderedDict:
-    output: OrderedDict = OrderedDict(
-        {root_directory: ArchSection(root_directory, "", 0, f"# {title}\n", title)}
+) -> Iterator[ArchSection]:
+    """Yield output sections in document order, starting with the root section"""
+    root_directory = _to_posix(root_directory)
+    # Held back until the root readme (if included) has been seen
+    root_section: Optional[ArchSection] = ArchSection(
+        root_directory, "", 0, f"# {title}\n", title
     )
+    # Relative paths of everything yielded so far, used to find missing parents
+    seen_prefixes: Set[str] = set()
+    # Boilerplate readmes repeated across the tree are only reformatted once
+    # per level, and only for the length of this traversal
+    reformatted: Dict[Tuple[str, int], str] = {}
 
     # Store anything needed to operate relative to the project root
     root_path_level = _get_absolute_path_level(root_directory)
+    # Walked paths all start with this, so relative paths are plain slices
+    root_prefix: str = (
+        root_directory if root_directory.endswith("/") else root_directory + "/"
+    )
+
+    directories: List[Tuple[str, Optional[str]]] = list(
+        _iter_dirs(root_directory, readme_filename)
+    )
+
+    # Read all readmes up front in parallel, then build sections in walk order
+    readme_paths: List[str] = [
+        readme_path
+        for directory_path, readme_path in directories
+        if readme_path and (include_root or directory_path != root_directory)
+    ]
+    with ThreadPoolExecutor(max_workers=_MAX_READ_WORKERS) as executor:
+        readmes: Dict[str, Optional[str]] = dict(
+            zip(readme_paths, executor.map(_get_readme, readme_paths))
+        )
 
-    for directory_path, *_ in os.walk(root_directory):
-        relative_path = os.path.relpath(directory_path, root_directory)
+    for directory_path, readme_path in directories:
+        relative_path: str = (
+            directory_path[len(root_prefix) :]
+            if directory_path != root_directory
+            else "."
+        )
 
         # Calculate path level relative to root (starting at 1 for the root)
         path_level = _get_absolute_path_level(directory_path) - root_path_level + 1
@@ -115,55 +222,68 @@ def _build_doc_dict(
             "Operating in path %s at path level %i", directory_path, path_level
         )
 
-        # Skip root if includeroot is false, or part of the path is a dotfile
-        if (
-            directory_path == root_directory
-            and not include_root
-            and not _is_dotfile(directory_path)
-        ):
-            pass
+        # Skip root if includeroot is false
+        if directory_path == root_directory and not include_root:
+            continue
 
-        else:
-            readme: Optional[str] = _get_readme(directory_path, readme_filename)
+        if readme_path:
+            readme: Optional[str] = readmes.pop(readme_path)
+            if readme is not None:
+                _warn_bad_format(readme, readme_path)
 
             if readme:
-                _create_parents(output, directory_path, root_directory)
-                output[directory_path] = ArchSection(
+                key: Tuple[str, int] = (readme, path_level)
+                if key not in reformatted:
+                    reformatted[key] = _reformat_readme(readme, path_level)
+
+                section = ArchSection(
                     directory_path,
                     relative_path,
                     path_level,
-                    _reformat_readme(readme, path_level),
-                    directory_path.split("/")[-1].capitalize(),
+                    reformatted[key],
+                    directory_path.rpartition("/")[2].capitalize(),
                 )
+                seen_prefixes.add(relative_path)
 
-    return output
+                # The root readme replaces the title section. The root is
+                # always walked first, so nothing has been yielded yet.
+                if directory_path == root_directory:
+                    root_section = section
+                    continue
+
+                if root_section is not None:
+                    yield root_section
+                    root_section = None
+                yield from _create_parents(seen_prefixes, relative_path, root_prefix)
+                yield section
+
+    if root_section is not None:
+        yield root_section
 
 
 def _make_toc_entry(title: str, level: int, link: str):
     # Invent by level - 2
     # -1 to remove the root ToC level
     # -1 to start at 0, not 1
-    return f"{'  ' * (level - 2)}- [{title}](#{link})\n"
+    indent: str = _repeat(_INDENTS, "  ", level - 2)
+    return f"{indent}- [{title}](#{link})\n"
 
 
 def _traverse_readmes(root: str, fname: str, includeroot: bool, title: str) -> str:
-    doc_dict: OrderedDict[str, ArchSection] = _build_doc_dict(
-        root, fname, includeroot, title
-    )
+    sections: Iterator[ArchSection] = _iter_sections(root, fname, includeroot, title)
 
-    header: str = doc_dict[root].body
-    body: str = ""
-    toc: str = "\n"
+    header: str = next(sections).body
+    body_parts: List[str] = []
+    toc_parts: List[str] = ["\n"]
 
-    for key, section in doc_dict.items():
-        if key != root:
-            anchorlabel: str = section.relative_path.strip(".").strip("/")
-            anchorname: str = anchorlabel.replace("/", "-")
+    for section in sections:
+        anchorlabel: str = section.relative_path.strip(".").strip("/")
+        anchorname: str = anchorlabel.replace("/", "-")
 
-            body += f'\n<a name="{anchorname}"></a>\n\n{section.body}'
-            toc += _make_toc_entry(anchorlabel, section.level, anchorname)
+        body_parts.append(f'\n<a name="{anchorname}"></a>\n\n{section.body}')
+        toc_parts.append(_make_toc_entry(anchorlabel, section.level, anchorname))
 
-    return header + toc + body
+    return header + "".join(toc_parts) + "".join(body_parts)
 
 
 app = typer.Typer()